@@ -19,9 +19,12 @@ torch.autograd.set_detect_anomaly(True)
 # Set the environment name. This model is currently tested on CartPole-v1
 DISPLAY_MODE = "human"
 environment_name = 'ALE/Breakout-v5'
-env = gym.make(environment_name, render_mode=DISPLAY_MODE)
-env.metadata['render_fps'] = 30
-env = ImageToPyTorch(env)
+# Rendering slows every step down, so only the snapshot epochs play in the rendered environment. See `main()`.
+env_fast = ImageToPyTorch(gym.make(environment_name))
+env_render = gym.make(environment_name, render_mode=DISPLAY_MODE)
+env_render.metadata['render_fps'] = 30
+env_render = ImageToPyTorch(env_render)
+env = env_fast
 
 # Choose device automatically
 device = torch.device(
@@ -48,6 +51,7 @@ else: model_to_load = ""
 
 BATCH_SIZE = 64 # The number of transitions per mini-batch [Default: 64]
 INPUT_N_STATES = 4 # The number of consecutive states to be concatenated for the observation/input. [Default: 4]
+N_ACT = env.action_space.n # The number of discrete actions, read once from the environment.
 
 TRAIN_INTERVAL = 1 # The number of frames between each training step. [Default: 1]
 SAVE_INTERVAL = 5000 # The number of frames between saving the model to a file. [Default: 500]
@@ -79,9 +83,10 @@ MEMORY_REWARD_THRESH = 0.00 # Assume  anything with less abs(reward) isn't usefu
 DISABLE_RANDOM = False # Disable epsilon_greedy exploration function. [Default: False]
 SAVING_ENABLED = True # Enable saving of model files. [Default: True]
 LEARNING_ENABLED = True # Enable model training. [Default: True]
+# Unlike cartpole.py and lunarlander.py, this script has no COMPILE_ENABLED or AUTOCAST_ENABLED, its models always run eager in float32.
 
 eps = 0.5 # Starting epsilon value, used in the epsilon_greedy policy. [Default: 0.5]
-EPS_DECAY = 0.0001 # How much epsilon decays each time a random action is chosen. [Default: 0.0001]
+EPS_DECAY = 0.0004 # How much epsilon decays each time a random action is chosen. Epsilon is rolled once per step, this used to be 0.0001 rolled in each of the 4 forwards per step. [Default: 0.0004]
 MIN_EPS = 0.05 # Minimum epsilon/random action chance. Keep this above 0 to encourage continued learning. [Default: 0.01]
 
 PLOT_DETAIL = 10000 # The maximum number of points to display at once, afterward this amount of points will be uniformly pulled from the set of all points.
@@ -144,7 +149,7 @@ class Decoder(torch.nn.Module):
 
 decoder_model = Decoder()
 decoder_model.to(device)
-coder_optimizer = torch.optim.RAdam(list(encoder_model.parameters()) + list(decoder_model.parameters()), lr=CODER_LR)
+coder_optimizer = torch.optim.RAdam(list(encoder_model.parameters()) + list(decoder_model.parameters()), lr=CODER_LR, foreach=True)
 
 class CustomDQN(torch.nn.Module):
     """
@@ -158,7 +163,8 @@ class CustomDQN(torch.nn.Module):
         self.lin_2a (nn.Linear): Hidden layer for Q-value prediction.
         self.lin_oA (nn.Linear): Output layer for Q-value prediction.
 
-        self.lin_2b (nn.Linear): Hidden layer for next state prediction.
+        self.lin_2b_s (nn.Linear): State part of the hidden layer for next state prediction.
+        self.lin_2b_a (nn.Embedding): Action part of the hidden layer for next state prediction.
         self.lin_oB (nn.Linear): Output layer for next state prediction.
     """
     def __init__(self, isPred):
@@ -175,25 +181,27 @@ class CustomDQN(torch.nn.Module):
         self.lin_1 = nn.Linear(ENCODER_NODES, 64)
 
         self.lin_2a = nn.Linear(64, 64)
-        self.lin_oA = nn.Linear(64, env.action_space.n)
+        self.lin_oA = nn.Linear(64, N_ACT)
 
-        self.lin_2b = nn.Linear(64 + env.action_space.n, 64)
+        self.lin_2b_s = nn.Linear(64, 64)
+        self.lin_2b_a = nn.Embedding(N_ACT, 64)
+        # Start the action weights at the scale of the old nn.Linear(64 + N_ACT, 64) one-hot input, instead of nn.Embedding's N(0, 1) init
+        nn.init.uniform_(self.lin_2b_a.weight, -(64 + N_ACT) ** -0.5, (64 + N_ACT) ** -0.5)
         self.lin_oB = nn.Linear(64, ENCODER_NODES)
 
-    def forward(self, x, real_actions=None, training=False):
-        global eps
+    def forward(self, x, real_actions=None, need_b=True):
         """
         The feed-forward/step function of the model.
 
         Parameters:
             x (torch.tensor): The input state tensor for the model.
-            real_actions (torch.tensor): A batch of real actions the model took, only used in training.
-            training (boolean): Enable training-specific changes. i.e. Disables greedy-epsilon.
+            real_actions (torch.tensor): A batch of real actions the model took, only used in training. If there are fewer actions than states, only the leading states get a next state prediction.
+            need_b (boolean): Run the next state prediction head. If False, b is returned as None.
         
         Returns:
             tuple (a, b):
                 - a (torch.tensor): The output action Q-values.
-                - b (torch.tensor): The predicted next state.
+                - b (torch.tensor | None): The predicted next state.
         """
         
         x = F.leaky_relu(self.lin_1(x)) # Take state as input and run through 1 linear layer
@@ -202,11 +210,10 @@ class CustomDQN(torch.nn.Module):
         a = F.leaky_relu(self.lin_2a(x))
         a = self.lin_oA(a)
 
-        explore, eps = greedy_epsilon.choose(eps)
-        if not training and explore:
-            a = torch.rand_like(a) * 2 - 1
-        elif not training: print(f"{a} {torch.argmax(a)}")
-        
+        # Skip the next state prediction head when only the Q-values are used
+        if not need_b:
+            return a, None
+
         chosen_actions = torch.argmax(a, dim=1)
 
         # During training, the action is not taken.
@@ -214,15 +221,39 @@ class CustomDQN(torch.nn.Module):
         if real_actions != None:
             chosen_actions = real_actions
 
-        one_hot_encoded_action = torch.zeros_like(a).scatter_(1, chosen_actions.unsqueeze(1), 1.)
-        
-        # Second head predicts next state from state + Q-values
-        b = torch.cat((x, one_hot_encoded_action), dim=1)
-        b = F.leaky_relu(self.lin_2b(b))
+            # Rows of x without a real action only needed Q-values
+            x = x[:chosen_actions.shape[0]]
+
+        # Second head predicts next state from state + action.
+        # The action's contribution is looked up from an embedding instead of concatenating an encoded action onto x.
+        b = F.leaky_relu(self.lin_2b_s(x) + self.lin_2b_a(chosen_actions))
         b = self.lin_oB(b)
 
         return a, b
 
+    def __setstate__(self, state):
+        """
+        Restores a pickled model, splitting the `lin_2b` layer of models saved before `lin_2b_s` and `lin_2b_a` existed.
+        The old layer took a one-hot action, so each embedding row is that action's weight column.
+
+        Parameters:
+            state (dict): The pickled attributes of the model.
+        """
+        super(CustomDQN, self).__setstate__(state)
+
+        lin_2b = self._modules.pop('lin_2b', None)
+        if lin_2b is None:
+            return
+
+        weight = lin_2b.weight.detach()
+        self.lin_2b_s = nn.Linear(64, 64, device=weight.device, dtype=weight.dtype)
+        self.lin_2b_a = nn.Embedding(N_ACT, 64, device=weight.device, dtype=weight.dtype)
+        action_weight = weight[:, 64:].T
+        with torch.no_grad():
+            self.lin_2b_s.weight.copy_(weight[:, :64])
+            self.lin_2b_s.bias.copy_(lin_2b.bias)
+            self.lin_2b_a.weight.copy_(action_weight)
+
 actor_model = CustomDQN(isPred=False)
 if model_to_load != "":
     actor_model = torch.load(f"models/{environment_name}/actor_model_{load_step}.pth")
@@ -232,8 +263,10 @@ if model_to_load != "":
 pred_model = CustomDQN(isPred=True)
 pred_model.load_state_dict(actor_model.state_dict())
 pred_model.eval()
+# actor_model and encoder_model are deliberately left in train mode for acting as well, they have no dropout or batch norm so switching modes every step would change nothing.
 
-actor_optimizer = torch.optim.RAdam(actor_model.parameters(), lr=ACTOR_LR)
+# foreach=True updates all parameters with a few multi-tensor kernels, instead of a Python loop over each tensor.
+actor_optimizer = torch.optim.RAdam(actor_model.parameters(), lr=ACTOR_LR, foreach=True)
 
 actor_model.to(device)
 pred_model.to(device)
@@ -293,7 +326,7 @@ def try_learning():
     if len(actor_mem.memory) > BATCH_SIZE:
         if step % TRAIN_INTERVAL == 0:
             a_loss = model_train(BATCH_SIZE)
-            multiplot.add_entry('a_loss', a_loss.cpu().detach().numpy())
+            multiplot.queue_entry('a_loss', a_loss)
 
             if last_c_loss > CODER_SHUTOFF_LOSS:
                 c_loss = train_coder(BATCH_SIZE)
@@ -308,7 +341,8 @@ def try_learning():
         torch.save(decoder_model, f"models/{environment_name}/decoder_model_{step}.pth")
 
 
-short_memory = []
+short_memory = [] # The (state, action, next_state) of the most recent transitions, oldest first.
+short_rewards = np.zeros(REWARD_AFFECT_PAST_N + 1, dtype=np.float32) # The reward of each short_memory transition, short_rewards[i] belongs to short_memory[i].
 
 def affect_short_mem(reward):
     """
@@ -326,8 +360,9 @@ def affect_short_mem(reward):
     # Only apply if the current reward exceeds a threshold. 
     # Affect short_memory reward values based on reward recieved currently, diminishing for less recent events.
     if reward < REWARD_AFFECT_THRESH[0] or reward > REWARD_AFFECT_THRESH[1]:
-        for i in range(0, len(short_memory)):
-            short_memory[-(i + 1)][3] += reward / (i + 1)
+        # The most recent sample gets reward / 1, the oldest gets reward / len(short_memory)
+        n = len(short_memory)
+        short_rewards[:n] += reward / np.arange(n, 0, -1, dtype=np.float32)
 
 def send_short_to_long_mem(n):
     """
@@ -336,28 +371,77 @@ def send_short_to_long_mem(n):
     Parameters:
         n (int): The number of elements to send from short_memory to actor_mem.
     """
+    rewards = short_rewards[:n].tolist()
+
+    # Shift the remaining rewards down, so they line up with short_memory again
+    short_rewards[:len(short_rewards) - n] = short_rewards[n:]
+
     for i in range(0, n):
         # Remove the first element
-        short_mem = short_memory.pop(0)
+        short_mem = Transition(*short_memory.pop(0), rewards[i])
 
         # Log it as real reward
-        multiplot.add_entry('real_reward', short_mem[3][0].cpu().detach())
+        multiplot.add_entry('real_reward', short_mem.reward)
 
         # Put it into actor_mem (which is used for training), if the absolute value of the reward is high enough
-        if abs(short_mem[3]) >= MEMORY_REWARD_THRESH:
+        if abs(short_mem.reward) >= MEMORY_REWARD_THRESH:
             actor_mem.push(short_mem)
 
 
 # initialize observation tensors
-obs_stack = deque(maxlen=INPUT_N_STATES)
-
 next_obs, info = env.reset()
-next_obs = torch.tensor(next_obs).to(device)
 
-while len(obs_stack) < INPUT_N_STATES:
-    obs_stack.append(next_obs)
+# The observation tensors are sized from a real observation, ImageToPyTorch swaps the axes differently than its observation_space reports.
+# Observations are staged through a pinned host tensor, so their copy to the device doesn't block the CUDA stream.
+host_obs = torch.empty(next_obs.shape, dtype=torch.float32, pin_memory=device.type == "cuda")
+# Every frame is written twice, at obs_idx and obs_idx + INPUT_N_STATES, so the newest INPUT_N_STATES frames are
+# always the contiguous slice obs_stack[obs_idx:obs_idx + INPUT_N_STATES], and never need to be concatenated or rolled.
+obs_stack = torch.empty(2 * INPUT_N_STATES, *next_obs.shape, device=device)
+obs_idx = 0
+
+def fill_obs_stack(obs):
+    """
+    Fill every frame of `obs_stack` with the same observation, used at the start of an epoch.
+
+    Parameters:
+        obs (np.ndarray): The observation to fill `obs_stack` with.
+
+    Returns:
+        next_state_tensor (torch.tensor): A view of the newest `INPUT_N_STATES` frames, concatenated along the channels.
+    """
+    global obs_idx
+
+    # Nothing has read an action back since the last frame's copy, so wait for it before overwriting host_obs. This only runs once per epoch.
+    if device.type == "cuda":
+        torch.cuda.current_stream().synchronize()
+
+    host_obs.numpy()[:] = obs
+    obs_stack.copy_(host_obs.expand_as(obs_stack), non_blocking=True)
+    obs_idx = 0
+
+    return obs_stack[:INPUT_N_STATES].flatten(0, 1)
+
+def push_obs(obs):
+    """
+    Write `obs` over the oldest frame of `obs_stack`, and advance `obs_idx`.
+
+    Parameters:
+        obs (np.ndarray): The newest observation.
+
+    Returns:
+        next_state_tensor (torch.tensor): A view of the newest `INPUT_N_STATES` frames, concatenated along the channels.
+    """
+    global obs_idx
+
+    # host_obs is free to overwrite here, the previous copy finished before the last action was read back.
+    host_obs.numpy()[:] = obs
+    obs_stack[obs_idx].copy_(host_obs, non_blocking=True)
+    obs_stack[obs_idx + INPUT_N_STATES].copy_(obs_stack[obs_idx])
+    obs_idx = (obs_idx + 1) % INPUT_N_STATES
 
-next_state_tensor = torch.cat([*obs_stack], dim=0).to(device)
+    return obs_stack[obs_idx:obs_idx + INPUT_N_STATES].flatten(0, 1)
+
+next_state_tensor = fill_obs_stack(next_obs)
 
 cumulative_reward = 0
 def model_infer():
@@ -369,26 +453,34 @@ def model_infer():
 
     Repeat until the episode ends.
     """
-    global step, obs_stack, cumulative_reward, next_obs, next_state_tensor
+    global step, eps, cumulative_reward, next_obs, next_state_tensor
 
     done = False
     cumulative_reward = 0
+
+    # obs_stack is overwritten in place, so transitions keep their own copies of the states.
+    # Each next state is copied once, and reused as the state of the following transition.
+    state_tensor = next_state_tensor.unsqueeze(0).clone()
     while not done:
-        state_tensor = next_state_tensor.unsqueeze(0).float()
-        actor_model.eval()
-        encoder_model.eval()
         with torch.no_grad():
             encoded_state = encoder_model.forward(state_tensor)
-            out, _ = actor_model.forward(encoded_state)
+            out, _ = actor_model.forward(encoded_state, need_b=False)
+
+            # Exploration is rolled once per step here, instead of in every forward
+            explore, eps = greedy_epsilon.choose(eps)
+            if explore:
+                out = torch.rand_like(out) * 2 - 1
+            else: print(f"{out} {torch.argmax(out)}")
 
-            multiplot.add_entry('output_0', float(out.clone()[0].tolist()[0]))
-            multiplot.add_entry('output_1', float(out.clone()[0].tolist()[1]))
-            multiplot.add_entry('output_2', float(out.clone()[0].tolist()[2]))
-            multiplot.add_entry('output_3', float(out.clone()[0].tolist()[3]))
+            multiplot.queue_entry('output_0', out[0, 0])
+            multiplot.queue_entry('output_1', out[0, 1])
+            multiplot.queue_entry('output_2', out[0, 2])
+            multiplot.queue_entry('output_3', out[0, 3])
 
         max_a = torch.argmax(out, dim=1)
+        action = int(max_a.item())
 
-        next_obs, reward, terminated, truncated, info = env.step(max_a.cpu().numpy()[0])
+        next_obs, reward, terminated, truncated, info = env.step(action)
         multiplot.add_entry('natural_reward', reward)
 
         cumulative_reward += reward
@@ -406,14 +498,14 @@ def model_infer():
 
         affect_short_mem(reward)
         
-        next_obs = torch.tensor(next_obs).to(device)
-        obs_stack.append(next_obs)
-        next_state_tensor = torch.cat([*obs_stack], dim=0).float().to(device)
-        
-        reward = torch.tensor(np.expand_dims(reward, 0), dtype=torch.float32).to(device)
+        next_state_tensor = push_obs(next_obs)
+        next_state = next_state_tensor.unsqueeze(0).clone()
 
-        mem_block = [state_tensor, max_a, next_state_tensor.unsqueeze(0), reward]
+        # The action is kept as a host int and the reward in short_rewards, they are only moved to the device when sampled for training
+        mem_block = [state_tensor, action, next_state]
+        state_tensor = next_state
 
+        short_rewards[len(short_memory)] = reward
         short_memory.append(mem_block)
 
         if done: send_short_to_long_mem(len(short_memory))
@@ -422,6 +514,9 @@ def model_infer():
         model_adjuster.soft_hard_copy(step, actor_model, pred_model)
         step += 1
 
+        # Copy this step's device-side log values to the host in one non-blocking batch
+        multiplot.flush_queue()
+
 
 
 def train_coder(batch_size):
@@ -435,9 +530,6 @@ def train_coder(batch_size):
     Returns:
         actor_loss (torch.tensor): Returns the loss of the actor, essentially its error from the target outputs.
     """
-    encoder_model.train()
-    decoder_model.train()
-
     transitions = actor_mem.sample(batch_size)
     mem_batch = Transition(*zip(*transitions))
 
@@ -455,7 +547,7 @@ def train_coder(batch_size):
     # Train Encoder/Decoder nets
     coder_criterion = nn.MSELoss()
     coder_loss = coder_criterion(decoded_state, state_batch) + coder_criterion(decoded_next_state, next_state_batch)
-    coder_optimizer.zero_grad()
+    coder_optimizer.zero_grad(set_to_none=True)
     coder_loss.backward()
     coder_optimizer.step()
 
@@ -473,23 +565,23 @@ def model_train(batch_size):
     Returns:
         actor_loss (torch.tensor): Returns the loss of the actor, essentially its error from the target outputs.
     """
-    actor_model.train()
-
     transitions = actor_mem.sample(batch_size)
     mem_batch = Transition(*zip(*transitions))
 
     # Concatenate mem_batch elements to tensors batches
     state_batch = torch.cat(mem_batch.state, dim=0).to(device)
-    action_batch = torch.cat(mem_batch.action, dim=0).to(device)
+    action_batch = torch.tensor(mem_batch.action, device=device)
     next_state_batch = torch.cat(mem_batch.next_state, dim=0).to(device)
-    reward_batch = torch.cat(mem_batch.reward, dim=0).to(device) # 64
+    reward_batch = torch.tensor(mem_batch.reward, dtype=torch.float32, device=device) # 64
 
     # Get the new model output for each state in the batch, including a guess at the next state
     encoded_state = encoder_model.forward(state_batch)
     encoded_next_state = encoder_model.forward(next_state_batch)
 
-    # Train actor / policy net
-    state_values, next_state_guess = actor_model.forward(encoded_state, real_actions=action_batch, training=True)
+    # Train actor / policy net, running the states and next states through one forward pass.
+    # Only the states have real actions, so next_state_guess is only predicted for them.
+    values, next_state_guess = actor_model.forward(torch.cat((encoded_state, encoded_next_state)), real_actions=action_batch)
+    state_values, actor_next_preds = values[:batch_size], values[batch_size:]
 
     # Calculate surprisal based on difference of guessed state and real state
     pred_diff = encoded_next_state - next_state_guess
@@ -498,36 +590,32 @@ def model_train(batch_size):
     diff_from_mean_pred_diff = abs_pred_diff - torch.mean(abs_pred_diff)
     surprisal = torch.sum(diff_from_mean_pred_diff, dim=1)
     scaled_surprisal = (surprisal + SURPRISAL_BIAS) * SURPRISAL_WEIGHT
-    multiplot.add_entry("surprisal", (torch.max(scaled_surprisal) - torch.min(scaled_surprisal)).cpu().detach().numpy() * 50000)
+    multiplot.queue_entry("surprisal", (torch.max(scaled_surprisal) - torch.min(scaled_surprisal)) * 50000)
     
-    # Gather the Q-value of the actual actions chosen.
-    state_actions = state_values.gather(1, action_batch.unsqueeze(1)) # 64, 1
+    # Index the Q-value of the actual actions chosen, keeping everything 1-D.
+    batch_idx = torch.arange(batch_size, device=device)
+    state_actions = state_values[batch_idx, action_batch] # 64
 
     with torch.no_grad():
         # Select next action using current model
-        actor_next_preds, _ = actor_model.forward(encoded_next_state, training=True) # 64, 2
         actor_pred_max_a = torch.argmax(actor_next_preds, dim=1) # 64
         
         # Predict target Q-value at next_state using the more stable prediction model
-        pred_out, _ = pred_model.forward(encoded_next_state, training=True) # 64, 2
-        next_state_actions = pred_out.gather(1, actor_pred_max_a.unsqueeze(1)) # 64, 1
+        pred_out, _ = pred_model.forward(encoded_next_state, need_b=False) # 64, 2
+        next_state_actions = pred_out[batch_idx, actor_pred_max_a] # 64
 
     # Generate the target output, by adding the reward at each transition, to the Q-value of the next action (predicted reward) * GAMMA, a discount factor.
-    target_output = scaled_surprisal.unsqueeze(1) + reward_batch.unsqueeze(1) + (next_state_actions * GAMMA)
+    target_output = scaled_surprisal + reward_batch + (next_state_actions * GAMMA)
 
     # Loss is the difference between the target outputs and the real outputs,
     # plus the difference between the next state and the predicted next state.
-    actor_criterion = nn.HuberLoss()
-    actor_loss = actor_criterion(state_actions, target_output) + actor_criterion(next_state_guess, encoded_next_state)
-    actor_optimizer.zero_grad()
+    actor_loss = F.huber_loss(state_actions, target_output) + F.huber_loss(next_state_guess, encoded_next_state)
+    actor_optimizer.zero_grad(set_to_none=True)
     actor_loss.backward(retain_graph=True)
 
-    # Log gradient norm
-    grad_norm = np.sqrt(sum([torch.norm(p.grad)**2 for p in actor_model.parameters()]).detach().cpu())
-    multiplot.add_entry('grad_norm', grad_norm)
-
-    # Clip gradients for stability
-    torch.nn.utils.clip_grad_value_(actor_model.parameters(), 1)
+    # Clip gradients for stability, this also returns the total gradient norm for logging
+    grad_norm = torch.nn.utils.clip_grad_norm_(actor_model.parameters(), max_norm=1.0)
+    multiplot.queue_entry('grad_norm', grad_norm)
     actor_optimizer.step()
 
     return actor_loss
@@ -535,33 +623,19 @@ def model_train(batch_size):
 
 
 def main():
-    global step, env, next_obs, obs_stack, next_state_tensor
+    global step, env, next_obs, next_state_tensor
 
     for epoch in tqdm(range(EPOCHS)):
         # Decide whether to display the environment
         if epoch % SNAPSHOT_INTERVAL == 0 and (epoch != 0 or SHOW_FIRST):
-            render_mode = DISPLAY_MODE
+            env = env_render
         else:
-            pass
-            #render_mode = None
-
-        # Load a new version of the environment with the chosen render_mode
-        # env = gym.make(environment_name, render_mode=DISPLAY_MODE)
-        # env.metadata['render_fps'] = 150
-        # env = ImageToPyTorch(env)
-        # TODO this doesn't work. Make render mode switching work if possible
+            env = env_fast
 
         next_obs, info = env.reset()
-        # env.render() - not necessary
 
         # Re-initialize obervations, etc.
-        obs_stack = deque(maxlen=INPUT_N_STATES)
-        next_obs = torch.tensor(next_obs).to(device)
-
-        while len(obs_stack) < INPUT_N_STATES:
-            obs_stack.append(next_obs)
-
-        next_state_tensor = torch.cat([*obs_stack], dim=0).to(device)
+        next_state_tensor = fill_obs_stack(next_obs)
 
         if len(info) > 0: print(info)
 
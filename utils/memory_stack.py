@@ -1,4 +1,6 @@
 import random
+import numpy as np
+import torch
 from collections import deque, namedtuple
 
 Transition = namedtuple('Transition',
@@ -40,4 +42,100 @@ class MemoryStack(object):
         Returns:
             array: An array containing `batch_size` individual samples from memory.
         """
-        return random.sample(self.memory, batch_size)
\ No newline at end of file
+        return random.sample(self.memory, batch_size)
+
+
+class ReplayBuffer(object):
+    """
+    This class creates a ReplayBuffer object with size `capacity`, storing each transition field in its own
+    preallocated host array. Upon reaching capacity the oldest transitions will be overwritten.
+
+    Attributes:
+        s (np.ndarray): The stored states, shape [capacity, state_dim].
+        a (np.ndarray): The stored actions, shape [capacity].
+        ns (np.ndarray): The stored next states, shape [capacity, state_dim].
+        r (np.ndarray): The stored rewards, shape [capacity].
+        rng (np.random.Generator): The generator sample indices are drawn from, seeded from torch's initial seed.
+        staging (tuple | None): Pinned host tensors each sampled batch is gathered into before its copy to a CUDA `.device`, allocated on the first sample.
+        copy_done (torch.cuda.Event | None): Recorded after the last batch's copies out of `.staging`.
+        pos (int): The index the next transition will be written to.
+        size (int): The number of transitions currently stored.
+    """
+    def __init__(self, capacity, state_dim, device):
+        """
+        The constructor for the ReplayBuffer class.
+
+        Parameters:
+            capacity (int): The number of transitions which will be stored before the oldest transitions start being overwritten.
+            state_dim (int): The length of a single flattened state.
+            device (torch.device): The device sampled batches are moved to.
+        """
+        self.capacity = capacity
+        self.device = device
+
+        self.s = np.empty((capacity, state_dim), dtype=np.float32)
+        self.a = np.empty(capacity, dtype=np.int64)
+        self.ns = np.empty((capacity, state_dim), dtype=np.float32)
+        self.r = np.empty(capacity, dtype=np.float32)
+
+        # Sampling stays reproducible under the scripts' torch.manual_seed()
+        self.rng = np.random.default_rng(torch.initial_seed())
+
+        self.staging = None
+        self.copy_done = None
+
+        self.pos = 0
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def push(self, transition):
+        """
+        Write a transition into the buffer at `.pos`, overwriting the oldest transition once the buffer is full.
+
+        Parameters:
+            transition (Transition): A (state, action, next_state, reward) transition of host values -- 1-d state arrays, an int action and a float reward.
+        """
+        state, action, next_state, reward = transition
+
+        self.s[self.pos] = state
+        self.a[self.pos] = action
+        self.ns[self.pos] = next_state
+        self.r[self.pos] = reward
+
+        self.pos = (self.pos + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def sample(self, batch_size):
+        """
+        Pull `batch_size` random transitions from the buffer, and move them to `.device`.
+
+        Parameters:
+            batch_size (int): The number of individual transitions to pull from the buffer.
+
+        Returns:
+            tuple (state_batch, action_batch, next_state_batch, reward_batch): The sampled transition fields, batched along dim 0.
+        """
+        # The buffer lives on the host, so the indices are drawn and gathered in numpy without a round trip through torch
+        idx = self.rng.integers(0, self.size, batch_size)
+        fields = (self.s, self.a, self.ns, self.r)
+
+        if self.device.type != "cuda":
+            return tuple(torch.from_numpy(x.take(idx, axis=0)).to(self.device) for x in fields)
+
+        # Pinned host memory lets the copies to the GPU run asynchronously, so the batch is gathered straight into reused pinned tensors
+        if self.staging is None or self.staging[0].shape[0] != batch_size:
+            self.staging = tuple(torch.empty((batch_size, *x.shape[1:]), dtype=torch.from_numpy(x).dtype, pin_memory=True) for x in fields)
+            self.copy_done = torch.cuda.Event()
+        else:
+            # Wait until the last batch has been copied out of the staging tensors before overwriting them
+            self.copy_done.synchronize()
+
+        for x, staged in zip(fields, self.staging):
+            np.take(x, idx, axis=0, out=staged.numpy())
+
+        batch = tuple(staged.to(self.device, non_blocking=True) for staged in self.staging)
+        self.copy_done.record()
+
+        return batch
@@ -1,4 +1,5 @@
 import numpy as np
+import torch
 import matplotlib.pyplot as plt
 
 PLOT_DETAIL = 10000 # The maximum number of points to display at once, afterward this amount of points will be uniformly pulled from the set of all points.
@@ -14,6 +15,9 @@ class Multiplot():
         names (list[str]): The list of line names, including row-breaks/column-breaks with "rb" and "cb".
         fig (matplotlib.figure.Figure): The multiplot figure.
         axs (matplotlib.axes.Axes): The axs of the multiplot.
+        queued_names (list[str]): The names of entries queued with `.queue_entry()`, waiting for `.flush_queue()`.
+        queued_entries (list[torch.tensor]): The device tensors queued with `.queue_entry()`.
+        pending (tuple | None): The (names, host tensor, copy event) of the last asynchronous copy started by `.flush_queue()`.
     """
     def __init__(self, names):
         self.fig, self.axs = plt.subplots(2, 2) # Generate original figure for matplotlib
@@ -25,6 +29,10 @@ class Multiplot():
         """
         self.plots = {} 
         self.names = names
+
+        self.queued_names = []
+        self.queued_entries = []
+        self.pending = None
         
         # Initialize empty array for each named line, excluding rb and cb flags
         ax_idx = [0, 0]
@@ -62,6 +70,49 @@ class Multiplot():
         """
 
         self.plots[name] = np.append(self.plots.get(name), entry)
+
+    def queue_entry(self, name, entry):
+        """
+        Queues a y-value that is still on the device, so it can be logged without syncing with the device.
+        Queued entries are added to the plot by `.flush_queue()`.
+
+        Parameters:
+            name (str): A name from the list this Multiplot was initalized with.
+            entry (torch.tensor): A single-element tensor.
+        """
+        self.queued_names.append(name)
+        # Keep a copy, the entry may be a CUDA graph output buffer that the next graph replay overwrites before `.flush_queue()`
+        self.queued_entries.append(entry.detach().reshape(1).clone())
+
+    def flush_queue(self):
+        """
+        Starts one non-blocking copy of all queued entries to the host, then adds the entries copied by the previous call.
+        Queued values reach the plot one call late, but logging them never waits on the device.
+        """
+        # Add the entries from the last call, their copy has had a whole step to finish
+        if self.pending is not None:
+            names, host_entries, copy_done = self.pending
+            if copy_done is not None:
+                copy_done.synchronize()
+
+            for name, entry in zip(names, host_entries.tolist()):
+                self.add_entry(name, entry)
+
+            self.pending = None
+
+        if len(self.queued_entries) > 0:
+            entries = torch.cat(self.queued_entries).float()
+
+            # Only CUDA copies are tracked with an event, so only those can safely be non-blocking
+            copy_done = None
+            host_entries = entries.to("cpu", non_blocking=entries.is_cuda)
+            if entries.is_cuda:
+                copy_done = torch.cuda.Event()
+                copy_done.record()
+
+            self.pending = (self.queued_names, host_entries, copy_done)
+            self.queued_names = []
+            self.queued_entries = []
     
     def plot_all(self, max_x):
         """